@@ -1,12 +1,38 @@
 # app.py
 from flask import Flask, request, jsonify, Response
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-import sqlite3, os, re, csv, random, secrets, io, traceback
+import orjson
+import sqlite3, os, re, csv, random, secrets, io, traceback, time, calendar, queue, itertools, hashlib
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from urllib.parse import quote
 from threading import Lock
 from datetime import datetime, timedelta
 
 app = Flask(__name__)
 
+# ---- JSON (orjson encoder behind every jsonify) ----
+class ORJSONProvider(DefaultJSONProvider):
+    """Encode responses with orjson; request parsing stays on the stdlib.
+    Note: output keys are no longer sorted (sort_keys is ignored). Anything
+    orjson rejects (e.g. ints beyond 64 bits) falls back to the stdlib encoder."""
+    def dumps(self, obj, **kwargs):
+        try:
+            return orjson.dumps(obj, default=self.default).decode()
+        except TypeError:  # orjson.JSONEncodeError subclasses TypeError
+            return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        try:
+            body = orjson.dumps(obj, default=self.default)
+        except TypeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+app.json = ORJSONProvider(app)
+
 # ---- CORS ----
 CORS(
     app,
@@ -31,19 +57,31 @@ CSV_FILE = os.environ.get("CODES_CSV", "codes.csv")
 MAX_DEVICES_DEFAULT = int(os.environ.get("MAX_DEVICES_DEFAULT", "1"))
 ADMIN_KEY = os.environ.get("ADMIN_KEY", "")
 MASTER_CODE = os.environ.get("MASTER_CODE", "").strip()
-lock = Lock()
+MAX_CODE_LEN = 32  # alphanumerics incl. prefix; longer input is rejected before any DB work
+MAX_RAW_LEN = 4 * MAX_CODE_LEN  # raw input incl. separators; longer input is never memoized
+NEG_CACHE_TTL = int(os.environ.get("NEG_CACHE_TTL", "60"))  # seconds; 0 disables
+POS_CACHE_TTL = int(os.environ.get("POS_CACHE_TTL", "300"))  # seconds; 0 disables
 
 # ===== Secure code alphabet + helpers (Base32 w/out 0/1/I/O) =====
 ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # 32 symbols
 ALPH_LEN = len(ALPHABET)
+_ALPH_MASK = ALPH_LEN - 1  # 32 symbols = 5 bits, so masking a random byte is uniform
+_ALPH_TRANS = bytes.maketrans(bytes(range(ALPH_LEN)), ALPHABET.encode("ascii"))
+_SYMBOL_BYTES = tuple(bytes((i,)) for i in range(ALPH_LEN))  # index -> 1-byte value
+_MASK_TRANS = bytes(b & _ALPH_MASK for b in range(256))       # any byte -> symbol index
+
+# Luhn "doubled" addend for every symbol index (only ALPH_LEN possible values).
+_DOUBLE_TBL = tuple((2 * v) // ALPH_LEN + (2 * v) % ALPH_LEN for v in range(ALPH_LEN))
 
 def luhn_mod_n_check_index(values, n=ALPH_LEN):
-    factor, total = 2, 0
+    if n != ALPH_LEN:
+        dbl = [(2 * v) // n + (2 * v) % n for v in range(n)]
+    else:
+        dbl = _DOUBLE_TBL
+    total, double = 0, True
     for v in reversed(values):
-        addend = factor * v
-        addend = (addend // n) + (addend % n)
-        total += addend
-        factor = 1 if factor == 2 else 2
+        total += dbl[v] if double else v
+        double = not double
     return (-total) % n
 
 def make_secure_code(prefix="", groups=4, group_len=4, add_check=True):
@@ -51,28 +89,56 @@ def make_secure_code(prefix="", groups=4, group_len=4, add_check=True):
     Returns (canonical_without_prefix_or_hyphens, display_with_prefix)
     Example display: TV-7XGM-Q2HN-8R3K-L   (last char is a check)
     """
-    payload_len = groups * group_len - (1 if add_check else 0)
-    vals = [secrets.randbelow(ALPH_LEN) for _ in range(payload_len)]
-    if add_check:
-        vals.append(luhn_mod_n_check_index(vals))
-    body = "".join(ALPHABET[v] for v in vals)
-    chunks = [body[i:i+group_len] for i in range(0, len(body), group_len)]
-    display = "-".join(chunks)
-    display = f"{prefix.strip().upper()}-{display}" if prefix else display
-    canonical = re.sub(r"[^A-Z0-9]", "", display)
-    if prefix:
-        canonical = canonical[len(prefix):]
-    return canonical, display
+    return make_secure_codes(1, prefix, groups, group_len, add_check)[0]
+
+def make_secure_codes(n, prefix="", groups=4, group_len=4, add_check=True):
+    """n x make_secure_code(); lengths, group offsets and prefix are worked out once."""
+    payload_len = max(groups * group_len - (1 if add_check else 0), 0)
+    starts = range(0, payload_len + (1 if add_check else 0), group_len)
+    head = f"{prefix.strip().upper()}-" if prefix else ""
+    # One urandom read for the whole batch, masked to symbol indices in C;
+    # 256 % 32 == 0, so masking stays uniform
+    pool = secrets.token_bytes(n * payload_len).translate(_MASK_TRANS)
+    codes = []
+    for off in range(0, n * payload_len, payload_len) if payload_len else range(n):
+        vals = pool[off:off + payload_len]  # bytes: iterating yields ints, no list copy
+        if add_check:
+            vals += _SYMBOL_BYTES[luhn_mod_n_check_index(vals)]
+        body = vals.translate(_ALPH_TRANS).decode("ascii")
+        # body is already the canonical form (alphabet symbols only, no prefix)
+        codes.append((body, head + "-".join([body[i:i+group_len] for i in starts])))
+    return codes
 
 # ===== Normalization / Canonicalization =====
 SECURE_BODY_LEN = 16  # length of the secure code body
 
+# Compiled once; measured faster than a str.translate delete-table on CPython 3.11
+_NON_CODE_RE = re.compile(r"[^A-Z0-9]")
+_NON_ALNUM_RE = re.compile(r"[^A-Za-z0-9]")
+
+def _memo_short(fn):
+    """lru_cache for inputs up to MAX_RAW_LEN; longer (untrusted) strings are
+    computed uncached, so a flood of large blobs can't fill the cache."""
+    cached = lru_cache(maxsize=4096)(fn)
+    @wraps(fn)
+    def wrapper(s):
+        if isinstance(s, str) and len(s) > MAX_RAW_LEN:
+            return fn(s)
+        return cached(s)
+    wrapper.cache_info, wrapper.cache_clear = cached.cache_info, cached.cache_clear
+    return wrapper
+
+# Pure str -> str and called several times per request with the same few
+# codes, so memoized (bounded, short inputs only).
+@_memo_short
 def normalize_code(s: str) -> str:
-    s = (s or "").strip().upper()
-    return re.sub(r"[^A-Z0-9]", "", s)
-
-SECURE_BODY_LEN = 16  # keep
+    s = (s or "").strip()
+    # Fast path: already canonical (what clients usually echo back)
+    if s.isascii() and s.isalnum() and s.isupper():
+        return s
+    return _NON_CODE_RE.sub("", s.upper())
 
+@_memo_short
 def to_canonical(code_str: str) -> str:
     """
     Accepts DISPLAY or raw. If the code has a short letter prefix like 'TV-',
@@ -87,15 +153,183 @@ def to_canonical(code_str: str) -> str:
         first, *rest = raw.split("-")
         if first.isalpha() and 1 <= len(first) <= 4:
             raw = "-".join(rest)
-    s = re.sub(r"[^A-Za-z0-9]", "", raw).upper()
+    s = _NON_ALNUM_RE.sub("", raw).upper()
     return s[-SECURE_BODY_LEN:] if len(s) > SECURE_BODY_LEN else s
 
+# Fixed for the process lifetime, so canonicalized once
+_MASTER_CANON = to_canonical(MASTER_CODE)
+_MASTER_TTL = timedelta(days=3650)
+
+# ===== Expiry: ISO text for humans, epoch seconds (ExpiryTs) for comparisons =====
+def _epoch(dt: datetime) -> int:
+    """Naive datetimes are taken as UTC (that's how we write them)."""
+    return calendar.timegm(dt.utctimetuple())
+
+def _iso_to_epoch(expiry_str):
+    try:
+        return _epoch(datetime.fromisoformat(expiry_str.strip()))
+    except Exception:
+        return None
+
+def _expiry_after(days):
+    """Returns (iso_with_Z, epoch_seconds) for now + days."""
+    dt = datetime.utcnow() + timedelta(days=days)
+    return dt.isoformat() + "Z", _epoch(dt)
+
+# ---- Connections ----
+# Per-connection settings, applied once when a pooled handle is opened.
+# WAL itself is persistent in the DB file (set once in init_db); with WAL,
+# synchronous=NORMAL skips the per-commit fsync -- a power cut may drop the
+# last commits but cannot corrupt the DB.
+_PRAGMAS = """
+    PRAGMA busy_timeout=5000;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-20000;
+    PRAGMA mmap_size=268435456;
+"""
+
+def _configure(conn, *extra):
+    conn.executescript(_PRAGMAS + "".join(f"PRAGMA {p};" for p in extra))
+    return conn
+
+def _connect():
+    """Read-write handle."""
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, cached_statements=256)
+    return _configure(conn, "synchronous=NORMAL")
+
+def _connect_ro():
+    """Read-only handle for listing/reporting; can never take the write lock."""
+    conn = sqlite3.connect(f"file:{quote(os.path.abspath(DB_FILE))}?mode=ro", uri=True,
+                           check_same_thread=False, cached_statements=256)
+    return _configure(conn, "query_only=1")
+
+# Shared SQL text: sqlite3 caches prepared statements per connection keyed on
+# the exact string, so every writer must use the same constant.
+_SQL_UPSERT_CODE = """
+    INSERT INTO codes (Code, Used, BuyerName, Expiry, MaxDevices, ExpiryTs)
+    VALUES (?, 'No', ?, ?, ?, ?)
+    ON CONFLICT(Code) DO UPDATE SET
+        Used='No', BuyerName=excluded.BuyerName,
+        Expiry=excluded.Expiry, MaxDevices=excluded.MaxDevices,
+        ExpiryTs=excluded.ExpiryTs
+"""
+
+# Process-wide pools of reusable writer and reader handles. Write serialization
+# is left to SQLite (BEGIN IMMEDIATE + busy_timeout), which also covers other
+# gunicorn workers. Connections are opened lazily and dropped after fork, so
+# handles opened in the preloaded gunicorn master are never used by a worker.
+POOL_SIZE = int(os.environ.get("DB_POOL_SIZE") or os.cpu_count() or 2)  # idle handles kept per pool
+_writers = queue.Queue()
+_readers = queue.Queue()
+
+def _reset_pool():
+    global _writers, _readers
+    _writers, _readers = queue.Queue(), queue.Queue()
+
+os.register_at_fork(after_in_child=_reset_pool)
+
+@contextmanager
+def _pooled(pool, factory):
+    try:
+        conn = pool.get_nowait()
+    except queue.Empty:
+        conn = factory()
+    try:
+        yield conn
+    finally:
+        if pool.qsize() < POOL_SIZE:
+            pool.put(conn)
+        else:
+            conn.close()
+
+@contextmanager
+def _write_conn():
+    """Writer inside BEGIN IMMEDIATE: commit on success, rollback on error."""
+    with _pooled(_writers, _connect) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        with conn:
+            yield conn
+
+def _read_conn():
+    return _pooled(_readers, _connect_ro)
+
 # ---- DB init (with CSV UPSERT in canonical form) ----
+CSV_SEED_BATCH = 10_000
+
+def _csv_seed_rows(reader):
+    """Yield normalized codes rows from a codes.csv DictReader. Rows without an
+    Expiry are stored with none (NULL), which /validate treats as 30 days from
+    each check, the same rolling window the per-boot reseed used to give."""
+    for row in reader:
+        code = to_canonical(row.get("Code"))
+        if not code:
+            continue
+        used   = (row.get("Used") or "No").strip()
+        buyer  = (row.get("BuyerName") or "").strip()
+        expiry = (row.get("Expiry") or "").strip()
+        try:
+            maxdev = int((row.get("MaxDevices") or MAX_DEVICES_DEFAULT) or 1)
+        except Exception:
+            maxdev = MAX_DEVICES_DEFAULT
+        expiry_ts = _iso_to_epoch(expiry) if expiry else None
+        yield (code, used, buyer, expiry or None, maxdev, expiry_ts)
+
+def _csv_sig_key(path):
+    """meta key holding the last-seeded signature of one CSV (one key per file)."""
+    return f"csv_sig:{os.path.abspath(path)}"
+
+def _csv_seeded(c, path, sig):
+    """True if `sig` is already recorded for this CSV path."""
+    seeded = c.execute("SELECT Value FROM meta WHERE Key=?", (_csv_sig_key(path),)).fetchone()
+    return bool(sig) and seeded is not None and seeded[0] == sig
+
+def _seed_csv(c, path, sig):
+    """UPSERT a codes.csv in bounded executemany batches (memory stays flat on
+    huge files) and record its signature under its own meta key. Runs inside
+    the caller's transaction."""
+    n = 0
+    with open(path, newline="", encoding="utf-8") as f:
+        rows = _csv_seed_rows(csv.DictReader(f))
+        while True:
+            chunk = list(itertools.islice(rows, CSV_SEED_BATCH))
+            if not chunk:
+                break
+            c.executemany("""
+                INSERT INTO codes (Code, Used, BuyerName, Expiry, MaxDevices, ExpiryTs)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(Code) DO UPDATE SET
+                  Used       = excluded.Used,
+                  BuyerName  = excluded.BuyerName,
+                  Expiry     = excluded.Expiry,
+                  MaxDevices = excluded.MaxDevices,
+                  ExpiryTs   = excluded.ExpiryTs
+            """, chunk)
+            n += len(chunk)
+    c.execute("""
+        INSERT INTO meta (Key, Value) VALUES (?, ?)
+        ON CONFLICT(Key) DO UPDATE SET Value=excluded.Value
+    """, (_csv_sig_key(path), sig))
+    return n
+
+def _csv_signature(path):
+    """Cheap change detector for the seed CSV: path + size + mtime (None if missing)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+_db_ready = False  # init_db runs once per process (import, preload, __main__)
+
 def init_db():
+    global _db_ready
+    if _db_ready:
+        return
     db_dir = os.path.dirname(DB_FILE)
     if db_dir:
         os.makedirs(db_dir, exist_ok=True)
-    with sqlite3.connect(DB_FILE) as conn:
+    with _connect() as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
         c = conn.cursor()
         c.execute("""
             CREATE TABLE IF NOT EXISTS codes (
@@ -103,7 +337,8 @@ def init_db():
                 Used TEXT DEFAULT 'No',
                 BuyerName TEXT,
                 Expiry TEXT,
-                MaxDevices INTEGER DEFAULT 1
+                MaxDevices INTEGER DEFAULT 1,
+                ExpiryTs INTEGER
             )
         """)
         c.execute("""
@@ -115,70 +350,175 @@ def init_db():
                 FOREIGN KEY (Code) REFERENCES codes(Code) ON DELETE CASCADE
             )
         """)
-        try:
-            c.execute("SELECT MaxDevices FROM codes LIMIT 1")
-        except sqlite3.OperationalError:
-            c.execute("ALTER TABLE codes ADD COLUMN MaxDevices INTEGER DEFAULT 1")
-        conn.commit()
-
-        # Seed/refresh from CSV (UPSERT), storing canonical Code
-        if os.path.exists(CSV_FILE):
-            with open(CSV_FILE, newline="", encoding="utf-8") as f:
-                reader = csv.DictReader(f)
-                for row in reader:
-                    raw_code = row.get("Code")
-                    code = to_canonical(raw_code)
-                    if not code:
-                        continue
-                    used   = (row.get("Used") or "No").strip()
-                    buyer  = (row.get("BuyerName") or "").strip()
-                    expiry = (row.get("Expiry") or "").strip()
-                    try:
-                        maxdev = int((row.get("MaxDevices") or MAX_DEVICES_DEFAULT) or 1)
-                    except Exception:
-                        maxdev = MAX_DEVICES_DEFAULT
-                    if not expiry:
-                        expiry = (datetime.utcnow() + timedelta(days=30)).isoformat() + "Z"
-
-                    c.execute("""
-                        INSERT INTO codes (Code, Used, BuyerName, Expiry, MaxDevices)
-                        VALUES (?, ?, ?, ?, ?)
-                        ON CONFLICT(Code) DO UPDATE SET
-                          Used       = excluded.Used,
-                          BuyerName  = excluded.BuyerName,
-                          Expiry     = excluded.Expiry,
-                          MaxDevices = excluded.MaxDevices
-                    """, (code, used, buyer, expiry, maxdev))
-            conn.commit()
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS meta (
+                Key TEXT PRIMARY KEY,
+                Value TEXT
+            )
+        """)
+        # Columns added after the original (import_csv.py) schema
+        for col, decl in (("Expiry", "TEXT"), ("MaxDevices", "INTEGER DEFAULT 1"), ("ExpiryTs", "INTEGER")):
+            try:
+                c.execute(f"SELECT {col} FROM codes LIMIT 1")
+            except sqlite3.OperationalError:
+                c.execute(f"ALTER TABLE codes ADD COLUMN {col} {decl}")
+        # Backfill epoch expiry for rows written before the column existed
+        c.execute("""
+            UPDATE codes SET ExpiryTs = CAST(strftime('%s', Expiry) AS INTEGER)
+            WHERE ExpiryTs IS NULL AND Expiry IS NOT NULL AND Expiry <> ''
+        """)
+        # Rows written outside the app (e.g. import_csv.py) may hold display-form
+        # codes; normalize them (uppercase, alphanumerics only) so lookups can use
+        # the Code primary key. No prefix strip or truncation: that is lossy and
+        # the /validate suffix probe already finds the full normalized form.
+        # The GLOB filter keeps already-normalized rows out of Python.
+        conn.create_function("normalize_code", 1, normalize_code.__wrapped__, deterministic=True)
+        for table in ("codes", "activations"):
+            c.execute(f"""
+                UPDATE OR IGNORE {table} SET Code = normalize_code(Code)
+                WHERE Code GLOB '*[^A-Z0-9]*' AND normalize_code(Code) <> ''
+            """)
+
+        # Seed/refresh from CSV (UPSERT), storing canonical Code.
+        # Skipped when the CSV is unchanged since the last seed of this DB.
+        # Signatures are kept per CSV path, so importing another file via
+        # import_csv.py never makes CODES_CSV look changed. The single shared
+        # 'csv_sig' key of earlier builds is dropped (one reseed on upgrade).
+        c.execute("DELETE FROM meta WHERE Key='csv_sig'")
+        csv_sig = _csv_signature(CSV_FILE)
+        if csv_sig and not _csv_seeded(c, CSV_FILE, csv_sig):
+            _seed_csv(c, CSV_FILE, csv_sig)
+
+        # Refresh planner stats where they are missing/stale (cheap no-op otherwise)
+        c.execute("PRAGMA optimize")
+    _db_ready = True
 
 init_db()
 
+def import_csv(path=CSV_FILE, force=False):
+    """Import a codes CSV, e.g. from import_csv.py; returns rows written, or
+    None when skipped because this exact file is already recorded as seeded
+    (init_db() just seeded it, or it is unchanged since the last import).
+    force=True re-imports regardless."""
+    sig = _csv_signature(path)
+    with _write_conn() as conn:
+        c = conn.cursor()
+        if not force and _csv_seeded(c, path, sig):
+            return None
+        n = _seed_csv(c, path, sig)
+    _clear_caches()
+    return n
+
 # ---- Health ----
+# Health checks hit these constantly; let proxies/clients cache and revalidate.
+SERVICE_VERSION = "v7-canonical-upsert"
+_WHOAMI_ETAG = hashlib.md5(f"{DB_FILE}|{SERVICE_VERSION}".encode()).hexdigest()
+
 @app.get("/whoami")
 def whoami():
-    return jsonify({
-        "service": os.environ.get("RENDER_SERVICE_NAME", "local"),
-        "env": os.environ.get("RENDER_EXTERNAL_URL", "n/a"),
-        "version": "v7-canonical-upsert",
-        "time": datetime.utcnow().isoformat() + "Z",
-        "db_file": DB_FILE
-    })
+    if _WHOAMI_ETAG in request.if_none_match:
+        resp = Response(status=304)
+    else:
+        resp = jsonify({
+            "service": os.environ.get("RENDER_SERVICE_NAME", "local"),
+            "env": os.environ.get("RENDER_EXTERNAL_URL", "n/a"),
+            "version": SERVICE_VERSION,
+            "time": datetime.utcnow().isoformat() + "Z",
+            "db_file": DB_FILE
+        })
+    resp.set_etag(_WHOAMI_ETAG)
+    resp.headers["Cache-Control"] = "public, max-age=30"
+    return resp
 
 @app.get("/")
 def home():
-    return "Access Code Validator & Housie90 API (Device-Bound) 🚀"
+    resp = Response("Access Code Validator & Housie90 API (Device-Bound) 🚀", mimetype="text/html")
+    resp.headers["Cache-Control"] = "public, max-age=3600"
+    return resp
 
 # ---- Helpers ----
+class _TTLCache:
+    """Small thread-safe TTL map; when full, the oldest entry is evicted."""
+    def __init__(self, maxsize, ttl):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._data = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        hit = self._data.get(key)
+        if hit is None:
+            return None
+        value, expires = hit
+        if expires <= time.monotonic():
+            with self._lock:
+                self._data.pop(key, None)
+            return None
+        return value
+
+    def put(self, key, value):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            if len(self._data) >= self.maxsize:
+                self._data.pop(next(iter(self._data)))
+            self._data[key] = (value, time.monotonic() + self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+# Terminal /validate rejects (not_found / expired) per input code. Any admin
+# write clears it; other workers catch up within NEG_CACHE_TTL.
+_neg_cache = _TTLCache(4096, NEG_CACHE_TTL)
+# Granted (code, device) pairs, so repeat launches skip SQLite entirely.
+# Same invalidation rules as the negative cache.
+_pos_cache = _TTLCache(10_000, POS_CACHE_TTL)
+
+def _clear_caches():
+    _neg_cache.clear()
+    _pos_cache.clear()
+
+def _granted(code, device_id, expires_at, reason):
+    return jsonify({
+        "valid": True,
+        "token": f"lic-{code}-{device_id}",
+        "expires_at": expires_at,
+        "device_registered": True,
+        "reason": reason
+    }), 200
+
+def _bad_code(raw):
+    """True for input that can't be a code (non-string or too long)."""
+    return raw is not None and (not isinstance(raw, str) or len(raw) > MAX_RAW_LEN
+                                or len(normalize_code(raw)) > MAX_CODE_LEN)
+
 def _auth_ok(req):
     return ADMIN_KEY and req.headers.get("X-Admin-Key") == ADMIN_KEY
 
-def _get_max_devices(row):
-    try:
-        return int(row["MaxDevices"] if isinstance(row, sqlite3.Row) else row[4])
-    except Exception:
-        return MAX_DEVICES_DEFAULT
-
 # ---- VALIDATE (device-bound; single implementation, two paths) ----
+# Fixed SQL text, so each pooled connection prepares these once and then
+# reuses them from its statement cache.
+# Canonical code + every suffix of the raw input, all primary-key probes;
+# the canonical form wins, then the longest suffix.
+_SQL_CODE_LOOKUP = (f"SELECT Code, ExpiryTs FROM codes WHERE Code IN (?{',?' * MAX_CODE_LEN})"
+                    " ORDER BY Code = ? DESC, length(Code) DESC LIMIT 1")
+_SQL_DEVICE_SEEN = "SELECT 1 FROM activations WHERE Code = ? AND DeviceID = ?"
+# Registers the device only while the code is under its limit; a row comes back
+# iff a new activation was written (existing device -> conflict, full -> no row).
+_SQL_ACTIVATE = """
+    INSERT INTO activations (Code, DeviceID, FirstSeen)
+    SELECT ?1, ?2, ?3
+    WHERE (SELECT COUNT(*) FROM activations WHERE Code = ?1)
+        < (SELECT COALESCE(MaxDevices, ?4) FROM codes WHERE Code = ?1)
+    ON CONFLICT DO NOTHING
+    RETURNING 1
+"""
+_SQL_MARK_USED = """
+    UPDATE codes SET Used='Yes', BuyerName=COALESCE(?, BuyerName)
+    WHERE Code = ? AND lower(trim(COALESCE(Used, 'No'))) <> 'yes'
+"""
+
 @app.route("/validate", methods=["POST", "GET"])
 @app.route("/api/validate", methods=["POST", "GET"])
 def validate():
@@ -193,82 +533,85 @@ def validate():
             buyer     = (request.args.get("buyer") or "").strip()
             device_id = (request.args.get("device_id") or "").strip() or (request.headers.get("X-Device-Id") or "").strip()
 
+        # Reject empty and malformed input before touching the DB
+        if raw_code is None or (isinstance(raw_code, str) and not to_canonical(raw_code)):
+            return jsonify({"valid": False, "reason": "empty_code"}), 404
+        if _bad_code(raw_code):
+            return jsonify({"valid": False, "reason": "bad_code"}), 400
         code = to_canonical(raw_code)
         raw_norm = normalize_code(raw_code)
 
-        if not code:
-            return jsonify({"valid": False, "reason": "empty_code"}), 404
         if not device_id:
             return jsonify({"valid": False, "reason": "missing_device_id"}), 400
 
+        # One clock read per request
+        now_ts = time.time()
+        now = datetime.utcfromtimestamp(now_ts)
+        now_iso = now.isoformat() + "Z"
+
         # Master code (binds to device; long expiry)
-        if MASTER_CODE and code == to_canonical(MASTER_CODE):
+        if _MASTER_CANON and code == _MASTER_CANON:
             return jsonify({
                 "valid": True,
                 "token": f"master-{device_id}",
-                "expires_at": (datetime.utcnow()+timedelta(days=3650)).isoformat()+"Z",
+                "expires_at": (now + _MASTER_TTL).isoformat() + "Z",
                 "device_registered": True,
                 "reason": "master"
             }), 200
 
-        with lock, sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            c = conn.cursor()
-
-            # Exact canonical match
-            row = c.execute("""
-            SELECT Code, Used, BuyerName, Expiry, MaxDevices
-            FROM codes
-            WHERE UPPER(REPLACE(Code,'-','')) = UPPER(?)
-            OR UPPER(REPLACE(Code,'-','')) = UPPER(substr(?, -length(REPLACE(Code,'-',''))))
-            LIMIT 1
-            """, (code, raw_norm)).fetchone()
+        neg_key = (code, raw_norm)
+        cached = _neg_cache.get(neg_key)
+        if cached:
+            return jsonify({"valid": False, "reason": cached[0]}), cached[1]
+        pos_key = (code, raw_norm, device_id)
+        cached = _pos_cache.get(pos_key)
+        if cached and cached[1] > now_ts:
+            return _granted(cached[0], device_id, cached[2], "ok_same_device")
+
+        # Read-only pass first: lookups and the same-device fast path never
+        # take SQLite's write lock.
+        with _read_conn() as conn:
+            # One lookup (stored codes are canonical). Suffixes are padded with the
+            # canonical code to a fixed bind count, so this is one cached statement.
+            suffixes = [raw_norm[-k:] for k in range(len(raw_norm), 0, -1)]
+            suffixes += [code] * (MAX_CODE_LEN - len(suffixes))
+            row = conn.execute(_SQL_CODE_LOOKUP, (code, *suffixes, code)).fetchone()
 
             if not row:
+                _neg_cache.put(neg_key, ("not_found", 404))
                 return jsonify({"valid": False, "reason": "not_found"}), 404
+            db_code, expiry_ts = row  # plain tuple, only the columns used below
 
-            # Expiry
-            expiry_str = row["Expiry"]
-            try:
-                expiry = datetime.fromisoformat((expiry_str or "").replace("Z","")) if expiry_str else (datetime.utcnow() + timedelta(days=30))
-            except Exception:
-                expiry = datetime.utcnow() + timedelta(days=30)
-            if expiry <= datetime.utcnow():
+            # Expiry (integer compare; rows without a usable expiry get 30 days)
+            if expiry_ts is None:
+                expiry_ts = int(now_ts) + 30 * 86400
+            elif expiry_ts <= now_ts:
+                _neg_cache.put(neg_key, ("expired", 400))
                 return jsonify({"valid": False, "reason": "expired"}), 400
+            expires_at = datetime.utcfromtimestamp(expiry_ts).isoformat() + "Z"
 
             # Already activated on this device?
-            already = c.execute("SELECT 1 FROM activations WHERE Code=? AND DeviceID=?",
-                                (row["Code"], device_id)).fetchone()
-            if already:
-                return jsonify({
-                    "valid": True,
-                    "token": f"lic-{row['Code']}-{device_id}",
-                    "expires_at": expiry.isoformat()+"Z",
-                    "device_registered": True,
-                    "reason": "ok_same_device"
-                }), 200
-
-            # Device limit
-            cnt = c.execute("SELECT COUNT(*) FROM activations WHERE Code=?", (row["Code"],)).fetchone()[0]
-            max_devices = _get_max_devices(row)
-            if cnt >= max_devices:
+            already = conn.execute(_SQL_DEVICE_SEEN, (db_code, device_id)).fetchone()
+
+        def granted(reason):
+            _pos_cache.put(pos_key, (db_code, expiry_ts, expires_at))
+            return _granted(db_code, device_id, expires_at, reason)
+
+        if already:
+            return granted("ok_same_device")
+
+        # New device: escalate to BEGIN IMMEDIATE; the limit check and the
+        # registration are one statement, so they see the same committed state.
+        with _write_conn() as conn:
+            if not conn.execute(_SQL_ACTIVATE, (db_code, device_id, now_iso,
+                                                MAX_DEVICES_DEFAULT)).fetchone():
+                # Nothing written: either this device won a race, or the code is full
+                if conn.execute(_SQL_DEVICE_SEEN, (db_code, device_id)).fetchone():
+                    return granted("ok_same_device")
                 return jsonify({"valid": False, "reason": "device_limit"}), 403
+            conn.execute(_SQL_MARK_USED, (buyer, db_code))
 
-            # Register device + mark used
-            c.execute("INSERT OR IGNORE INTO activations (Code, DeviceID, FirstSeen) VALUES (?, ?, ?)",
-                      (row["Code"], device_id, datetime.utcnow().isoformat()+"Z"))
-            if str(row["Used"] or "No").strip().lower() != "yes":
-                c.execute("UPDATE codes SET Used='Yes', BuyerName=COALESCE(?, BuyerName) WHERE Code=?",
-                          (buyer, row["Code"]))
-            conn.commit()
-
-            return jsonify({
-                "valid": True,
-                "token": f"lic-{row['Code']}-{device_id}",
-                "expires_at": expiry.isoformat()+"Z",
-                "device_registered": True,
-                "reason": "ok_new_device"
-            }), 200
+        return granted("ok_new_device")
 
     except Exception:
         traceback.print_exc()
@@ -279,22 +622,16 @@ def validate():
 def admin_add_code():
     if not _auth_ok(request): return jsonify({"ok": False, "error": "unauthorized"}), 403
     data = request.get_json(silent=True) or {}
+    if _bad_code(data.get("code")): return jsonify({"ok": False, "error": "bad_code"}), 400
     code = to_canonical(data.get("code"))
     buyer = (data.get("buyer") or "").strip()
     days = int(data.get("days") or 30)
     max_devices = int(data.get("max_devices") or MAX_DEVICES_DEFAULT)
     if not code: return jsonify({"ok": False, "error": "missing_code"}), 400
-    expiry = (datetime.utcnow() + timedelta(days=days)).isoformat() + "Z"
-    with lock, sqlite3.connect(DB_FILE) as conn:
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO codes (Code, Used, BuyerName, Expiry, MaxDevices)
-            VALUES (?, 'No', ?, ?, ?)
-            ON CONFLICT(Code) DO UPDATE SET
-                Used='No', BuyerName=excluded.BuyerName,
-                Expiry=excluded.Expiry, MaxDevices=excluded.MaxDevices
-        """, (code, buyer, expiry, max_devices))
-        conn.commit()
+    expiry, expiry_ts = _expiry_after(days)
+    with _write_conn() as conn:
+        conn.execute(_SQL_UPSERT_CODE, (code, buyer, expiry, max_devices, expiry_ts))
+    _clear_caches()
     return jsonify({"ok": True, "code": code, "expiry": expiry, "max_devices": max_devices})
 
 @app.post("/admin/new_codes")  # legacy simple codes (now stored canonical)
@@ -305,24 +642,20 @@ def admin_new_codes():
     prefix = request.args.get("prefix")
     buyer  = request.args.get("buyer", "")
     max_devices = int(request.args.get("max_devices", MAX_DEVICES_DEFAULT))
-    expiry = (datetime.utcnow() + timedelta(days=days)).isoformat() + "Z"
+    expiry, expiry_ts = _expiry_after(days)
 
     def _make_code(prefix=None):
         body = (secrets.token_urlsafe(5).replace("_","").replace("-","").upper())[:10]
         return f"{prefix}-{body}" if prefix else body
 
-    made = []
-    with lock, sqlite3.connect(DB_FILE) as conn:
-        c = conn.cursor()
-        for _ in range(n):
-            raw = _make_code(prefix)
-            code = to_canonical(raw)
-            c.execute("""
-                INSERT OR IGNORE INTO codes (Code, Used, BuyerName, Expiry, MaxDevices)
-                VALUES (?, 'No', ?, ?, ?)
-            """, (code, buyer, expiry, max_devices))
-            made.append(raw)
-        conn.commit()
+    made = [_make_code(prefix) for _ in range(n)]
+    rows = [(to_canonical(raw), buyer, expiry, max_devices, expiry_ts) for raw in made]
+    with _write_conn() as conn:
+        conn.executemany("""
+            INSERT OR IGNORE INTO codes (Code, Used, BuyerName, Expiry, MaxDevices, ExpiryTs)
+            VALUES (?, 'No', ?, ?, ?, ?)
+        """, rows)
+    _clear_caches()
     return jsonify({"ok": True, "count": len(made), "expiry": expiry, "max_devices": max_devices, "codes": made})
 @app.post("/admin/bulk_add")
 def admin_bulk_add():
@@ -338,34 +671,31 @@ def admin_bulk_add():
     if not isinstance(raw_codes, list) or not raw_codes:
         return jsonify({"ok": False, "error": "no_codes"}), 400
 
-    expiry = (datetime.utcnow() + timedelta(days=days)).isoformat() + "Z"
+    expiry, expiry_ts = _expiry_after(days)
 
-    added, skipped = [], []
-    with lock, sqlite3.connect(DB_FILE) as conn:
-        c = conn.cursor()
-        for raw in raw_codes:
-            try:
-                code = to_canonical(raw)
-                raw_norm = normalize_code(raw_code)
-
-                if not code:
-                    skipped.append({"raw": raw, "reason": "empty"})
-                    continue
-                c.execute("""
-                    INSERT INTO codes (Code, Used, BuyerName, Expiry, MaxDevices)
-                    VALUES (?, 'No', ?, ?, ?)
-                    ON CONFLICT(Code) DO UPDATE SET
-                        Used='No', BuyerName=excluded.BuyerName,
-                        Expiry=excluded.Expiry, MaxDevices=excluded.MaxDevices
-                """, (code, buyer, expiry, max_devices))
-                added.append(code)
-            except Exception as e:
-                skipped.append({"raw": raw, "reason": str(e)})
-        conn.commit()
+    # Normalize up front, then hand SQLite one statement with N binds
+    rows, skipped = [], []
+    for raw in raw_codes:
+        if isinstance(raw, str) and len(raw) > MAX_RAW_LEN:
+            skipped.append({"raw": raw[:MAX_RAW_LEN], "reason": "too_long"})
+            continue
+        try:
+            code = to_canonical(raw)
+        except Exception as e:
+            skipped.append({"raw": raw, "reason": str(e)})
+            continue
+        if not code:
+            skipped.append({"raw": raw, "reason": "empty"})
+            continue
+        rows.append((code, buyer, expiry, max_devices, expiry_ts))
+
+    with _write_conn() as conn:
+        conn.executemany(_SQL_UPSERT_CODE, rows)
+    _clear_caches()
 
     return jsonify({
         "ok": True,
-        "added": len(added),
+        "added": len(rows),
         "skipped": skipped,
         "expiry": expiry,
         "max_devices": max_devices
@@ -374,12 +704,11 @@ def admin_bulk_add():
 def admin_new_codes_secure():
     if not _auth_ok(request): return jsonify({"ok": False, "error": "unauthorized"}), 403
 
-    payload = request.get_json(silent=True) or {}
-    q = request.args
+    # Query string wins over JSON body; merged once into a plain dict
+    params = {**(request.get_json(silent=True) or {}), **request.args.to_dict()}
 
     def pick(key, default=None, caster=lambda x: x):
-        val = q.get(key)
-        if val is None: val = payload.get(key)
+        val = params.get(key)
         if val is None: return default
         try: return caster(val)
         except Exception: return default
@@ -392,22 +721,15 @@ def admin_new_codes_secure():
     buyer       = (pick("buyer", "", str) or "").strip()
     max_devices = pick("max_devices", MAX_DEVICES_DEFAULT, int)
 
-    expiry = (datetime.utcnow() + timedelta(days=days)).isoformat() + "Z"
+    expiry, expiry_ts = _expiry_after(days)
 
-    made = []
-    with lock, sqlite3.connect(DB_FILE) as conn:
-        c = conn.cursor()
-        for _ in range(n):
-            canonical, display = make_secure_code(prefix=prefix, groups=groups, group_len=group_len, add_check=True)
-            c.execute("""
-                INSERT INTO codes (Code, Used, BuyerName, Expiry, MaxDevices)
-                VALUES (?, 'No', ?, ?, ?)
-                ON CONFLICT(Code) DO UPDATE SET
-                    Used='No', BuyerName=excluded.BuyerName,
-                    Expiry=excluded.Expiry, MaxDevices=excluded.MaxDevices
-            """, (canonical, buyer, expiry, max_devices))
-            made.append({"display": display, "canonical": canonical})
-        conn.commit()
+    # Generate everything first (outside the transaction), then one executemany
+    codes = make_secure_codes(n, prefix=prefix, groups=groups, group_len=group_len, add_check=True)
+    made = [{"display": display, "canonical": canonical} for canonical, display in codes]
+    rows = [(canonical, buyer, expiry, max_devices, expiry_ts) for canonical, _ in codes]
+    with _write_conn() as conn:
+        conn.executemany(_SQL_UPSERT_CODE, rows)
+    _clear_caches()
 
     return jsonify({
         "ok": True,
@@ -424,29 +746,31 @@ def admin_reset_code():
     data = request.get_json(silent=True) or {}
     raw = data.get("code")
     if not raw: return jsonify({"ok": False, "error": "missing_code"}), 400
+    if _bad_code(raw): return jsonify({"ok": False, "error": "bad_code"}), 400
     norm = to_canonical(raw)
-    with lock, sqlite3.connect(DB_FILE) as conn:
+    with _write_conn() as conn:
         c = conn.cursor()
-        c.execute("UPDATE codes SET Used='No' WHERE UPPER(REPLACE(Code,'-',''))=UPPER(?)", (norm,))
-        c.execute("DELETE FROM activations WHERE UPPER(REPLACE(Code,'-',''))=UPPER(?)", (norm,))
-        conn.commit()
+        c.execute("UPDATE codes SET Used='No' WHERE Code=?", (norm,))
+        c.execute("DELETE FROM activations WHERE Code=?", (norm,))
+    _clear_caches()
     return jsonify({"ok": True, "code": norm, "status": "reset"})
 
+_LIST_COLS = ("Code", "Used", "BuyerName", "Expiry", "MaxDevices")
+
 @app.get("/admin/list_codes")
 def admin_list_codes():
     if not _auth_ok(request): return jsonify({"ok": False, "error": "unauthorized"}), 403
     limit = int(request.args.get("limit", 200))
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute("SELECT Code, Used, BuyerName, Expiry, MaxDevices FROM codes ORDER BY Code LIMIT ?", (limit,))
-        rows = [dict(r) for r in c.fetchall()]
+    with _read_conn() as conn:
+        # Plain tuples zipped against fixed column names (no sqlite3.Row per row)
+        rows = [dict(zip(_LIST_COLS, r)) for r in conn.execute(
+            "SELECT Code, Used, BuyerName, Expiry, MaxDevices FROM codes ORDER BY Code LIMIT ?", (limit,))]
     return jsonify({"ok": True, "rows": rows, "count": len(rows)})
 
 @app.get("/admin/stats")
 def admin_stats():
     if not _auth_ok(request): return jsonify({"ok": False, "error": "unauthorized"}), 403
-    with sqlite3.connect(DB_FILE) as conn:
+    with _read_conn() as conn:
         c = conn.cursor()
         total = c.execute("SELECT COUNT(*) FROM codes").fetchone()[0]
         used  = c.execute("SELECT COUNT(*) FROM codes WHERE lower(Used)='yes'").fetchone()[0]
@@ -456,17 +780,35 @@ def admin_stats():
 @app.get("/admin/export_csv")
 def admin_export_csv():
     if not _auth_ok(request): return jsonify({"ok": False, "error": "unauthorized"}), 403
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["Code","Used","BuyerName","Expiry","MaxDevices"])
-    with sqlite3.connect(DB_FILE) as conn:
-        c = conn.cursor()
-        for row in c.execute("SELECT Code, Used, BuyerName, Expiry, MaxDevices FROM codes ORDER BY Code"):
-            writer.writerow(row)
-    csv_bytes = output.getvalue().encode("utf-8")
-    return Response(csv_bytes, mimetype="text/csv", headers={"Content-Disposition": "attachment; filename=codes_export.csv"})
+
+    def generate():
+        # Stream in 1000-row chunks: constant memory, first bytes out immediately
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(["Code","Used","BuyerName","Expiry","MaxDevices"])
+        yield buf.getvalue()
+        with _read_conn() as conn:
+            c = conn.execute("SELECT Code, Used, BuyerName, Expiry, MaxDevices FROM codes ORDER BY Code")
+            try:
+                while True:
+                    rows = c.fetchmany(1000)
+                    if not rows:
+                        break
+                    buf.seek(0)
+                    buf.truncate()
+                    writer.writerows(rows)
+                    yield buf.getvalue()
+            finally:
+                c.close()  # release the read snapshot before the connection goes back to the pool
+
+    return Response(generate(), mimetype="text/csv", headers={"Content-Disposition": "attachment; filename=codes_export.csv"})
 
 # ---- Tickets (strict) ----
+# Private PRNG (skips the module-level instance + attribute lookups per call).
+# Reseeded after fork so preloaded gunicorn workers don't deal identical tickets.
+_RNG = random.Random()
+os.register_at_fork(after_in_child=_RNG.seed)
+
 @app.get("/api/tickets")
 def api_tickets():
     try:
@@ -474,22 +816,14 @@ def api_tickets():
     except Exception:
         count = 1
     count = max(1, min(count, 60))
-    all_tickets = []
-    for _ in range(count):
-        for __ in range(6):
-            all_tickets.append(generate_ticket_strict())
-    return jsonify({"cards": all_tickets})
+    return jsonify({"cards": generate_tickets(count * 6)})  # 6 tickets per card
 
-def generate_ticket_strict():
-    # 9 columns: 1–9, 10–19, …, 80–90
-    cols = [
-        list(range(1,10)), list(range(10,20)), list(range(20,30)),
-        list(range(30,40)), list(range(40,50)), list(range(50,60)),
-        list(range(60,70)), list(range(70,80)), list(range(80,91))
-    ]
-    for c in cols:
-        random.shuffle(c)
+def generate_tickets(n):
+    """n strict tickets in one batch."""
+    gen = generate_ticket_strict
+    return [gen() for _ in range(n)]
 
+def _balanced_counts():
     # --- balanced per-column counts (sum=15, each 1..3), center-out spread ---
     counts = [1] * 9
     extras = 15 - sum(counts)  # 6 to distribute
@@ -505,74 +839,82 @@ def generate_ticket_strict():
                 counts[ci] += 1
                 extras -= 1
                 break
+    return counts
+
+# Deterministic, so computed once: columns grouped by how many numbers they hold
+_COL_COUNTS = tuple(_balanced_counts())
+_COLS_BY_COUNT = {k: tuple(ci for ci, cnt in enumerate(_COL_COUNTS) if cnt == k) for k in (1, 2, 3)}
+_THIRD = (0, 0, 0, 1, 1, 1, 2, 2, 2)  # column -> ticket third (cols 0-2, 3-5, 6-8)
+# 9 columns: 1–9, 10–19, …, 80–90
+_COL_SOURCES = (
+    tuple(range(1,10)), tuple(range(10,20)), tuple(range(20,30)),
+    tuple(range(30,40)), tuple(range(40,50)), tuple(range(50,60)),
+    tuple(range(60,70)), tuple(range(70,80)), tuple(range(80,91))
+)
+
+def generate_ticket_strict():
+    sample, rand, choice = _RNG.sample, _RNG.random, _RNG.choice
 
     # rows[r][ci] = 1 means a number will appear there
     rows = [[0] * 9 for _ in range(3)]
     row_used = [0, 0, 0]
 
-    thirds = [(0, 2), (3, 5), (6, 8)]
-    def third_idx(ci):
-        return 0 if ci <= 2 else (1 if ci <= 5 else 2)
-
     # coverage[r][t] = 1 if row r already has a number in third t
     coverage = [[0, 0, 0] for _ in range(3)]
 
     # 3-per-column: one in each row
-    for ci, cnt in enumerate(counts):
-        if cnt == 3:
-            for r in range(3):
-                rows[r][ci] = 1
-                row_used[r] += 1
-                coverage[r][third_idx(ci)] = 1
+    for ci in _COLS_BY_COUNT[3]:
+        for r in range(3):
+            rows[r][ci] = 1
+            row_used[r] += 1
+            coverage[r][_THIRD[ci]] = 1
 
     # 2-per-column: pick two rows with fewest used; prefer rows that still lack this third
-    for ci, cnt in enumerate(counts):
-        if cnt == 2:
-            t = third_idx(ci)
-            options = sorted(
-                range(3),
-                key=lambda r: (row_used[r], coverage[r][t], random.random())
-            )
-            placed = 0
-            for r in options:
-                if row_used[r] < 5:
+    for ci in _COLS_BY_COUNT[2]:
+        t = _THIRD[ci]
+        options = sorted(
+            range(3),
+            key=lambda r: (row_used[r], coverage[r][t], rand())
+        )
+        placed = 0
+        for r in options:
+            if row_used[r] < 5:
+                rows[r][ci] = 1
+                row_used[r] += 1
+                coverage[r][t] = 1
+                placed += 1
+                if placed == 2:
+                    break
+        # Fallback if something weird happens
+        if placed < 2:
+            for r in range(3):
+                if placed == 2:
+                    break
+                if rows[r][ci] == 0 and row_used[r] < 5:
                     rows[r][ci] = 1
                     row_used[r] += 1
                     coverage[r][t] = 1
                     placed += 1
-                    if placed == 2:
-                        break
-            # Fallback if something weird happens
-            if placed < 2:
-                for r in range(3):
-                    if placed == 2:
-                        break
-                    if rows[r][ci] == 0 and row_used[r] < 5:
-                        rows[r][ci] = 1
-                        row_used[r] += 1
-                        coverage[r][t] = 1
-                        placed += 1
 
     # 1-per-column: pick the row that still needs this third, then fewest used
-    for ci, cnt in enumerate(counts):
-        if cnt == 1:
-            t = third_idx(ci)
-            options = sorted(
-                range(3),
-                key=lambda r: (coverage[r][t], row_used[r], random.random())
-            )
-            chosen = None
-            for r in options:
-                if row_used[r] < 5:
-                    chosen = r
-                    break
-            if chosen is None:
-                # final fallback: any row with capacity, else the smallest
-                caps = [r for r in range(3) if row_used[r] < 5]
-                chosen = random.choice(caps) if caps else min(range(3), key=lambda r: row_used[r])
-            rows[chosen][ci] = 1
-            row_used[chosen] += 1
-            coverage[chosen][t] = 1
+    for ci in _COLS_BY_COUNT[1]:
+        t = _THIRD[ci]
+        options = sorted(
+            range(3),
+            key=lambda r: (coverage[r][t], row_used[r], rand())
+        )
+        chosen = None
+        for r in options:
+            if row_used[r] < 5:
+                chosen = r
+                break
+        if chosen is None:
+            # final fallback: any row with capacity, else the smallest
+            caps = [r for r in range(3) if row_used[r] < 5]
+            chosen = choice(caps) if caps else min(range(3), key=lambda r: row_used[r])
+        rows[chosen][ci] = 1
+        row_used[chosen] += 1
+        coverage[chosen][t] = 1
 
     # Light patching: if any row <5 (rare), borrow from the row with most cells
     for r in range(3):
@@ -584,7 +926,7 @@ def generate_ticket_strict():
             movable = [ci for ci in range(9) if rows[donor][ci] == 1 and rows[r][ci] == 0]
             if not movable:
                 break
-            ci = random.choice(movable)
+            ci = choice(movable)
             rows[donor][ci] = 0
             row_used[donor] -= 1
             rows[r][ci] = 1
@@ -594,15 +936,13 @@ def generate_ticket_strict():
             for rr in range(3):
                 for cidx in range(9):
                     if rows[rr][cidx]:
-                        coverage[rr][third_idx(cidx)] = 1
+                        coverage[rr][_THIRD[cidx]] = 1
 
     # --- assign actual numbers: ascending down each column ---
     ticket = [[0] * 9 for _ in range(3)]
     for ci in range(9):
         r_idxs = [r for r in range(3) if rows[r][ci] == 1]
-        need = len(r_idxs)
-        nums = sorted([cols[ci].pop() for _ in range(need)])
-        r_idxs.sort()
+        nums = sorted(sample(_COL_SOURCES[ci], len(r_idxs)))
         for k, r in enumerate(r_idxs):
             ticket[r][ci] = nums[k]
 
@@ -610,7 +950,6 @@ def generate_ticket_strict():
 
 
 if __name__ == "__main__":
-    init_db()
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
 
 
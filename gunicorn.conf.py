@@ -0,0 +1,11 @@
+# gunicorn.conf.py -- picked up automatically by `gunicorn app:app` (see Procfile)
+import multiprocessing, os
+
+# One worker per CPU, a few threads each (WEB_CONCURRENCY / GUNICORN_THREADS override)
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+
+# Import app.py (and run init_db + CSV seeding) once in the master, then fork.
+# No SQLite handle is open at fork time: connections are opened inside requests.
+preload_app = True
@@ -1,27 +1,17 @@
-import sqlite3
-import csv
+import sys
 
-DB_FILE = "codes.db"
-CSV_FILE = "codes.csv"
+# Shares the app's schema, canonical code form and batched UPSERT seeding;
+# importing app also creates/migrates the DB (DB_FILE / CODES_CSV env vars apply)
+# and already seeds CODES_CSV if it changed, so that file is not imported twice.
+# Usage: python import_csv.py [path.csv] [--force]
+import app
 
-# Create DB and table
-conn = sqlite3.connect(DB_FILE)
-cursor = conn.cursor()
-cursor.execute("""
-CREATE TABLE IF NOT EXISTS codes (
-    Code TEXT PRIMARY KEY,
-    Used TEXT DEFAULT 'No',
-    BuyerName TEXT
-)
-""")
-
-# Import CSV
-with open(CSV_FILE, newline='', encoding='utf-8') as f:
-    reader = csv.DictReader(f)
-    for row in reader:
-        cursor.execute(
-            "INSERT OR IGNORE INTO codes (Code, Used, BuyerName) VALUES (?, ?, ?)",
-            (row['Code'].strip(), row.get('Used', 'No').strip(), row.get('BuyerName', '').strip())
-        )
-conn.commit()
-conn.close()
+args = [a for a in sys.argv[1:] if a != "--force"]
+force = "--force" in sys.argv[1:]
+path = args[0] if args else app.CSV_FILE
+n = app.import_csv(path, force=force)
+if n is None:
+    print(f"{path} is unchanged since it was last seeded into {app.DB_FILE} "
+          "(at app startup or by a previous import); use --force to re-import")
+else:
+    print(f"Imported {n} codes from {path} into {app.DB_FILE}")